@@ -48,7 +48,7 @@
 #     }
 
 #     async with httpx.AsyncClient() as client:
-#         res = await client.post(token_url, data=data)
+#         res = await client.post(TOKEN_URL, data=data)
 #         token_data = res.json()
 
 #         # Error handling
@@ -75,44 +75,46 @@
 #     return {"message": "Login successful", "user": user_id}
 
 
-import os, httpx, base64, json
-from fastapi import APIRouter, Request
+import base64, orjson
+from fastapi import APIRouter, Depends, Request
 from fastapi.responses import RedirectResponse
 from urllib.parse import urlencode
-from dotenv import load_dotenv
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.db import get_db
+from settings import get_settings
 from utils.token_manager import save_tokens
+from utils.http_client import get_client
 
-load_dotenv()
 router = APIRouter()
 
-CLIENT_ID = os.getenv("CLIENT_ID")
-CLIENT_SECRET = os.getenv("CLIENT_SECRET")
-TENANT_ID = os.getenv("TENANT_ID")
-AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
-REDIRECT_URI = os.getenv("REDIRECT_URI")
-SCOPES = os.getenv("SCOPES")
+_S = get_settings()
+CLIENT_ID = _S.client_id
+CLIENT_SECRET = _S.client_secret.get_secret_value()
+AUTHORITY = _S.authority
+REDIRECT_URI = _S.redirect_uri
+SCOPES = _S.scopes
+
+# Built once; every input comes from the environment and never changes at runtime
+LOGIN_URL = f"{AUTHORITY}/oauth2/v2.0/authorize?" + urlencode({
+    "client_id": CLIENT_ID,
+    "response_type": "code",
+    "redirect_uri": REDIRECT_URI,
+    "response_mode": "query",
+    "scope": SCOPES
+})
+TOKEN_URL = _S.azure_token_url
 
 @router.get("/login")
 def login():
-    params = {
-        "client_id": CLIENT_ID,
-        "response_type": "code",
-        "redirect_uri": REDIRECT_URI,
-        "response_mode": "query",
-        "scope": SCOPES
-    }
-    auth_url = f"{AUTHORITY}/oauth2/v2.0/authorize?{urlencode(params)}"
-    return RedirectResponse(auth_url)
+    return RedirectResponse(LOGIN_URL)
 
 def extract_user_id_from_token(token: str) -> str:
-    payload = token.split(".")[1] + "==="
-    padded_payload = payload[:len(payload) - len(payload) % 4]  # Ensure correct padding
-    decoded = base64.urlsafe_b64decode(padded_payload).decode()
-    return json.loads(decoded)["preferred_username"]
+    payload = token.split(".")[1]
+    pad = -len(payload) % 4  # JWT segments are unpadded base64url
+    return orjson.loads(base64.urlsafe_b64decode(payload + "=" * pad))["preferred_username"]
 
 @router.get("/callback")
-async def auth_callback(code: str):
-    token_url = f"{AUTHORITY}/oauth2/v2.0/token"
+async def auth_callback(code: str, db: AsyncSession = Depends(get_db)):
     data = {
         "client_id": CLIENT_ID,
         "scope": SCOPES,
@@ -122,25 +124,25 @@ async def auth_callback(code: str):
         "client_secret": CLIENT_SECRET,
     }
 
-    async with httpx.AsyncClient() as client:
-        res = await client.post(token_url, data=data)
-        token_data = res.json()
+    client = get_client()
+    res = await client.post(TOKEN_URL, data=data)
+    token_data = orjson.loads(res.content)
 
-        access_token = token_data["access_token"]
-        refresh_token = token_data["refresh_token"]
-        expires_in = token_data["expires_in"]
+    access_token = token_data["access_token"]
+    refresh_token = token_data["refresh_token"]
+    expires_in = token_data["expires_in"]
 
-        # ✅ Fetch user info using /me
-        headers = {"Authorization": f"Bearer {access_token}"}
-        user_response = await client.get("https://graph.microsoft.com/v1.0/me", headers=headers)
+    # ✅ Fetch user info using /me
+    headers = {"Authorization": f"Bearer {access_token}"}
+    user_response = await client.get("https://graph.microsoft.com/v1.0/me", headers=headers)
 
-        if user_response.status_code != 200:
-            return {"error": "Failed to fetch user info."}
+    if user_response.status_code != 200:
+        return {"error": "Failed to fetch user info."}
 
-        user_info = user_response.json()
-        user_id = user_info["userPrincipalName"]  # or "mail" if you prefer
+    user_info = orjson.loads(user_response.content)
+    user_id = user_info["userPrincipalName"]  # or "mail" if you prefer
 
-        # ✅ Save tokens to DB
-        save_tokens(user_id, access_token, refresh_token, expires_in)
+    # ✅ Save tokens to DB
+    await save_tokens(db, user_id, access_token, refresh_token, expires_in)
 
-        return {"message": "Login successful", "user_id": user_id}
+    return {"message": "Login successful", "user_id": user_id}
@@ -56,14 +56,26 @@
 # app.include_router(debug_router)
 
 
+import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.templating import Jinja2Templates
 from auth.ms_auth import router as auth_router
 from ms_graph.mail import router as mail_router
 from models.db import init_db
-
-app = FastAPI()
-init_db()
+from utils.http_client import close_client, get_client
+from utils.responses import ORJSONResponse
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # ✅ Create tables at startup, not import; set RUN_DB_MIGRATIONS=0 when schema is managed by Alembic
+    if os.getenv("RUN_DB_MIGRATIONS", "1") == "1":
+        init_db()
+    get_client()  # open the shared Graph/token client before the first request
+    yield
+    await close_client()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 templates = Jinja2Templates(directory="templates")
 
@@ -1,27 +1,117 @@
 
 
-from sqlalchemy import Column, Integer, String, DateTime, create_engine
+from sqlalchemy import Boolean, Column, Integer, LargeBinary, String, DateTime, create_engine, event, inspect, make_url, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from datetime import datetime
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Request handlers use an async driver for the same database so DB I/O yields to
+# the event loop; the sync engine stays for DDL and bulk provisioning
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+}
+_url = make_url(DATABASE_URL)
+ASYNC_DATABASE_URL = _url.set(drivername=ASYNC_DRIVERS.get(_url.drivername, _url.drivername))
+
+# WAL lets readers proceed alongside the single writer
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+class utcnow(FunctionElement):
+    """Database-side UTC timestamp, naive like the DateTime columns it fills"""
+    type = DateTime()
+    inherit_cache = True
+
+@compiles(utcnow)
+def _utcnow_default(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"  # SQLite's CURRENT_TIMESTAMP is already UTC
+
+@compiles(utcnow, "postgresql")
+def _utcnow_postgresql(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
 Base = declarative_base()
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+if DATABASE_URL.startswith("sqlite"):
+    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+    async_engine = create_async_engine(ASYNC_DATABASE_URL)
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+else:
+    # Fail fast when the pool is exhausted instead of queueing for the 30s default
+    engine = create_engine(DATABASE_URL, pool_size=10, max_overflow=20, pool_timeout=5, pool_pre_ping=True)
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, pool_size=20, max_overflow=20, pool_timeout=5, pool_pre_ping=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 class TokenStore(Base):
     __tablename__ = "tokens"
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(String, index=True)
-    access_token = Column(String)
-    refresh_token = Column(String)
+    user_id = Column(String, unique=True, index=True)
+    # Raw AES-GCM output from utils.encryption; no base64 text layer.
+    # access_token is only read for rows saved before access tokens moved to
+    # the in-memory cache; new writes leave it NULL
+    access_token = Column(LargeBinary, nullable=True)
+    refresh_token = Column(LargeBinary)
     expires_in = Column(Integer)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    has_mailbox = Column(Boolean, nullable=True)  # None until the first messages fetch
+    created_at = Column(DateTime, server_default=utcnow())
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    upgrade_db()
+
+def upgrade_db():
+    """Bring a tokens table created by an older version up to the current model
+
+    create_all never alters an existing table, so columns and constraints added
+    since are applied here. Every step checks first, so reruns are no-ops.
+    """
+    table = TokenStore.__tablename__
+    inspector = inspect(engine)
+    columns = {c["name"]: c for c in inspector.get_columns(table)}
+    unique_user_id = any(
+        ix["unique"] and ix["column_names"] == ["user_id"] for ix in inspector.get_indexes(table)
+    ) or any(uc["column_names"] == ["user_id"] for uc in inspector.get_unique_constraints(table))
+
+    with engine.begin() as conn:
+        if "has_mailbox" not in columns:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN has_mailbox BOOLEAN"))
+        if not unique_user_id:
+            # The upsert's ON CONFLICT (user_id) needs a unique index; keep the
+            # newest row per user so it can be built
+            conn.execute(text(f"DELETE FROM {table} WHERE id NOT IN (SELECT MAX(id) FROM {table} GROUP BY user_id)"))
+            conn.execute(text("DROP INDEX IF EXISTS ix_tokens_user_id"))
+            conn.execute(text(f"CREATE UNIQUE INDEX ix_tokens_user_id ON {table} (user_id)"))
+        if engine.dialect.name == "postgresql":
+            # SQLite stores bytes in the old TEXT columns as-is; Postgres needs
+            # bytea, and decrypt still reads the converted base64 text
+            for name in ("access_token", "refresh_token"):
+                if not isinstance(columns[name]["type"], LargeBinary):
+                    conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {name} TYPE bytea USING convert_to({name}, 'UTF8')"))
+            if columns["created_at"]["default"] is None:
+                conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN created_at SET DEFAULT TIMEZONE('utc', CURRENT_TIMESTAMP)"))
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def upsert_insert(model):
+    """INSERT for the configured dialect, exposing on_conflict_do_update"""
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
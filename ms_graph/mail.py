@@ -1,197 +1,449 @@
 import os
+import time
+import asyncio
 import logging
+from collections import defaultdict
+from datetime import datetime
+from operator import itemgetter
 
-from fastapi import APIRouter, HTTPException
-from sqlalchemy.orm import Session
-from dotenv import load_dotenv
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import InvalidToken
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-import httpx
+import orjson
 
-from models.db import SessionLocal, TokenStore
+from models.db import TokenStore, get_db
+from settings import get_settings
 from utils.encryption import decrypt, encrypt
+from utils.http_client import get_client
+from utils.responses import ORJSONResponse
+from utils.token_cache import (
+    cache_access_token, cache_refresh_token, get_cached_access_token, get_cached_refresh_token,
+    invalidate_access_token, invalidate_refresh_token, token_is_fresh,
+)
 
 # ─── Load environment ──────────────────────────────────────────────────────────
-load_dotenv()
+_S = get_settings()
 
-CLIENT_ID = os.getenv("CLIENT_ID")
-CLIENT_SECRET = os.getenv("CLIENT_SECRET")
-TENANT_ID = os.getenv("TENANT_ID")
+AZURE_TOKEN_URL = _S.azure_token_url
 
-# Modified scopes - added offline_access and made them space-separated
-SCOPES = "openid profile email User.Read Mail.Read offline_access"
+# Static parts of every refresh POST; only refresh_token varies per call
+_REFRESH_BASE = {
+    "client_id": _S.client_id,
+    "client_secret": _S.client_secret.get_secret_value(),
+    "grant_type": "refresh_token",
+    "scope": _S.scopes,
+}
 
-AZURE_TOKEN_URL = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token"
 GRAPH_API = "https://graph.microsoft.com/v1.0"
 
+MESSAGES_PAGE_SIZE = 50
+MAX_MESSAGE_PAGES = 10
+MESSAGES_QUERY = f"$top={MESSAGES_PAGE_SIZE}&$select=subject,from,receivedDateTime,bodyPreview,isRead,hasAttachments"
+
+# /me and /me/messages combined into one Graph $batch request
+MAIL_BATCH_BODY = orjson.dumps({"requests": [
+    {"id": "me", "method": "GET", "url": "/me"},
+    {"id": "messages", "method": "GET", "url": f"/me/messages?{MESSAGES_QUERY}"},
+]})
+UNAUTHORIZED_BATCH = {"me": {"status": 401}, "messages": {"status": 401}}
+
+# $select guarantees these keys on every message, so one itemgetter call
+# replaces seven dict.get lookups; sparse payloads use the .get path
+_MSG_KEYS = itemgetter("id", "subject", "from", "receivedDateTime", "bodyPreview", "isRead", "hasAttachments")
+_EMPTY: dict = {}
+
+# Graph headers shared by every call; only Authorization varies per token
+_GRAPH_BASE_HEADERS = {
+    "Accept": "application/json",
+    # JSON message lists compress well; httpx decodes br when brotli is installed
+    "Accept-Encoding": "gzip, br",
+}
+
 # ─── Logger ────────────────────────────────────────────────────────────────────
 logger = logging.getLogger("mail_inbox")
 logger.setLevel(logging.DEBUG)
 
+# Self-limit outbound Microsoft calls so a burst queues here instead of
+# being 429-throttled by Graph
+GRAPH_MAX_CONCURRENCY = int(os.getenv("GRAPH_MAX_CONCURRENCY", 32))
+GRAPH_MAX_RETRIES = 2
+GRAPH_MAX_RETRY_AFTER = 30
+_graph_sem = asyncio.Semaphore(GRAPH_MAX_CONCURRENCY)
+
+# /me barely changes, so /user-info answers from memory for this long
+USERINFO_TTL_SECONDS = int(os.getenv("USERINFO_TTL_SECONDS", 900))
+_userinfo_cache: dict[str, tuple[dict, float]] = {}
+
+# Per-user refresh locks so concurrent 401s trigger a single token refresh
+_refresh_locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+_refresh_inflight: dict[str, asyncio.Future] = {}
+
+# Account the mail routes act on (they use the first token row); lets a cache
+# hit skip the DB lookup entirely
+_active_user_id: str | None = None
+# Primary key of that row, so repeat lookups are a PK get rather than a scan
+_token_row_id: int | None = None
+
 # ─── Helpers ───────────────────────────────────────────────────────────────────
-def get_db_session() -> Session:
-    return SessionLocal()
+def get_active_cached_token() -> str | None:
+    if _active_user_id is None:
+        return None
+    return get_cached_access_token(_active_user_id)
+
+async def load_token_entry(db: AsyncSession) -> TokenStore:
+    global _active_user_id, _token_row_id
+    token_entry = None
+    if _token_row_id is not None:
+        token_entry = await db.get(TokenStore, _token_row_id)
+    if token_entry is None:
+        token_entry = (await db.execute(select(TokenStore).limit(1))).scalar_one_or_none()
+    if not token_entry:
+        raise HTTPException(400, "No tokens found; please authenticate first")
+    _active_user_id = token_entry.user_id
+    _token_row_id = token_entry.id
+    return token_entry
+
+async def decrypt_stored(ciphertext) -> str:
+    """Decrypt a stored token off the event loop; unreadable rows need a new sign-in"""
+    try:
+        return await asyncio.to_thread(decrypt, ciphertext)
+    except (InvalidTag, InvalidToken, ValueError):
+        logger.warning("Stored token could not be decrypted")
+        raise HTTPException(401, "Stored token could not be read; please authenticate again")
 
-async def fetch_messages(access_token: str) -> httpx.Response:
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
+async def get_access_token(token_entry: TokenStore) -> str | None:
+    """Return the in-memory access token, or None when it has to be refreshed"""
+    access_token = get_cached_access_token(token_entry.user_id)
+    if access_token is None and token_entry.access_token is not None:
+        # Row saved before access tokens became memory-only; keep the AES
+        # work off the event loop
+        access_token = await decrypt_stored(token_entry.access_token)
+        if token_entry.expires_in:
+            cache_access_token(token_entry.user_id, access_token, token_entry.expires_in, token_entry.created_at)
+    return access_token
+
+async def graph_send(method: str, url: str, **kwargs):
+    """Send through the shared client under _graph_sem, honouring 429 Retry-After"""
+    for attempt in range(GRAPH_MAX_RETRIES + 1):
+        async with _graph_sem:
+            resp = await get_client().request(method, url, **kwargs)
+        if resp.status_code != 429 or attempt == GRAPH_MAX_RETRIES:
+            return resp
+        delay = retry_after_delay(resp.headers.get("Retry-After"))
+        logger.warning("Throttled by %s; retrying in %.1fs", url, delay)
+        # Sleep outside the semaphore so waiting retries don't hold slots
+        await asyncio.sleep(delay)
+
+def retry_after_delay(value) -> float:
+    """Seconds to wait for a Retry-After value, capped at GRAPH_MAX_RETRY_AFTER"""
+    try:
+        delay = float(value if value is not None else 1)
+    except (TypeError, ValueError):
+        delay = 1.0
+    return min(max(delay, 0.0), GRAPH_MAX_RETRY_AFTER)
+
+def get_cached_user_info(user_id: str | None) -> dict | None:
+    cached = _userinfo_cache.get(user_id)
+    if cached and time.monotonic() < cached[1]:
+        return cached[0]
+    return None
+
+def cache_user_info(user_id: str, user_data: dict) -> dict:
+    info = {
+        "displayName": user_data.get("displayName"),
+        "userPrincipalName": user_data.get("userPrincipalName"),
+        "mail": user_data.get("mail"),
+        "userType": user_data.get("userType"),
+        "accountEnabled": user_data.get("accountEnabled"),
+        "id": user_data.get("id"),
+        "hasMailbox": user_data.get("mail") is not None,
+        "isPersonalAccount": "#EXT#" in user_data.get("userPrincipalName", "")
     }
-    async with httpx.AsyncClient() as client:
+    _userinfo_cache[user_id] = (info, time.monotonic() + USERINFO_TTL_SECONDS)
+    return info
+
+def graph_headers(access_token: str) -> dict:
+    """Build once per access token and share across the Graph helpers"""
+    return {**_GRAPH_BASE_HEADERS, "Authorization": f"Bearer {access_token}"}
+
+async def fetch_user_and_messages(headers: dict) -> dict:
+    """Run /me and /me/messages as one Graph $batch call; sub-responses keyed by id"""
+    for attempt in range(GRAPH_MAX_RETRIES + 1):
         try:
-            # First try to get user's mailbox settings to check if mail is enabled
-            mailbox_resp = await client.get(
-                f"{GRAPH_API}/me/mailboxSettings",
-                headers=headers
+            resp = await graph_send(
+                "POST",
+                f"{GRAPH_API}/$batch",
+                content=MAIL_BATCH_BODY,
+                headers={**headers, "Content-Type": "application/json"}
             )
-            
-            if mailbox_resp.status_code == 200:
-                # If mailbox exists, fetch messages
-                return await client.get(
-                    f"{GRAPH_API}/me/messages?$top=50&$select=subject,from,receivedDateTime,bodyPreview,isRead,hasAttachments",
-                    headers=headers
-                )
-            else:
-                raise HTTPException(
-                    status_code=400,
-                    detail="User has no mailbox or mail access not enabled"
-                )
-                
-        except Exception as e:
-            logger.error(f"Error checking mailbox: {str(e)}")
+        except Exception:
+            logger.exception("Error fetching messages")
             raise HTTPException(
                 status_code=400,
                 detail="Could not verify mailbox access"
             )
 
-async def refresh_access_token(db: Session, token_entry: TokenStore) -> str:
+        if resp.status_code == 401:
+            return UNAUTHORIZED_BATCH
+        if resp.status_code != 200:
+            error_msg = resp.json().get("error", {}).get("message", "Unknown error")
+            raise HTTPException(resp.status_code, detail=error_msg)
+
+        batch = {r["id"]: r for r in orjson.loads(resp.content)["responses"]}
+        # Graph throttles a batch per sub-request: the envelope is 200 and
+        # each throttled entry carries its own 429 and Retry-After
+        throttled = [r for r in batch.values() if r["status"] == 429]
+        if not throttled or attempt == GRAPH_MAX_RETRIES:
+            return batch
+        delay = max(retry_after_delay(r.get("headers", {}).get("Retry-After")) for r in throttled)
+        logger.warning("Batch sub-requests throttled; retrying in %.1fs", delay)
+        await asyncio.sleep(delay)
+
+async def fetch_more_messages(headers: dict, first_page: dict, pages: int) -> list:
+    """Fetch pages 2..pages concurrently; they multiplex over the shared HTTP/2 connection"""
+    items = first_page.get("value", [])
+    if pages <= 1 or "@odata.nextLink" not in first_page:
+        return items
+
+    # nextLink only ever points one page ahead, so address later pages by
+    # $skip and request them all at once instead of walking the chain
+    responses = await asyncio.gather(*(
+        graph_send("GET", f"{GRAPH_API}/me/messages?{MESSAGES_QUERY}&$skip={page * MESSAGES_PAGE_SIZE}", headers=headers)
+        for page in range(1, pages)
+    ))
+    for resp in responses:
+        if resp.status_code != 200:
+            error_msg = resp.json().get("error", {}).get("message", "Unknown error")
+            raise HTTPException(resp.status_code, detail=error_msg)
+        value = orjson.loads(resp.content).get("value", [])
+        items.extend(value)
+        if len(value) < MESSAGES_PAGE_SIZE:
+            break  # ran past the end of the mailbox
+    return items
+
+def is_mailbox_missing(messages: dict) -> bool:
+    # No pre-flight mailboxSettings probe; Graph reports a missing mailbox
+    # on the messages call itself
+    if messages["status"] in (200, 401):
+        return False
+    return messages.get("body", {}).get("error", {}).get("code") == "MailboxNotEnabledForRESTAPI"
+
+async def record_mailbox(db: AsyncSession, token_entry: TokenStore | None, has_mailbox: bool):
+    """Persist the mailbox check once per account so later calls can skip it"""
+    if token_entry is not None and token_entry.has_mailbox != has_mailbox:
+        token_entry.has_mailbox = has_mailbox
+        await db.commit()
+
+def email_summary(m: dict) -> dict:
+    try:
+        id_, subject, sender, received, preview, is_read, has_attachments = _MSG_KEYS(m)
+    except KeyError:
+        return _email_summary_sparse(m)
+    return {
+        "id": id_,
+        "subject": subject,
+        "from": ((sender or _EMPTY).get("emailAddress") or _EMPTY).get("address"),
+        "receivedDate": received,
+        "preview": preview,
+        "isRead": is_read,
+        "hasAttachments": has_attachments
+    }
+
+def _email_summary_sparse(m: dict) -> dict:
+    return {
+        "id": m.get("id"),
+        "subject": m.get("subject"),
+        "from": m.get("from", {}).get("emailAddress", {}).get("address"),
+        "receivedDate": m.get("receivedDateTime"),
+        "preview": m.get("bodyPreview"),
+        "isRead": m.get("isRead", False),
+        "hasAttachments": m.get("hasAttachments", False)
+    }
+
+async def refresh_access_token(db: AsyncSession, token_entry: TokenStore) -> str:
     """Refresh access token with proper error handling"""
     if not token_entry or not token_entry.refresh_token:
         raise HTTPException(400, "No refresh token available")
     
+    # Single-flight: callers arriving mid-refresh await the same result
+    inflight = _refresh_inflight.get(token_entry.user_id)
+    while inflight is not None:
+        try:
+            return await asyncio.shield(inflight)
+        except asyncio.CancelledError:
+            if not inflight.cancelled():
+                raise  # this caller was cancelled, not the leader
+        # The leader was cancelled; take over unless another follower has
+        inflight = _refresh_inflight.get(token_entry.user_id)
+
+    future = asyncio.get_running_loop().create_future()
+    _refresh_inflight[token_entry.user_id] = future
     try:
-        refresh_token = decrypt(token_entry.refresh_token)
-        
-        payload = {
-            "client_id": CLIENT_ID,
-            "client_secret": CLIENT_SECRET,
-            "grant_type": "refresh_token",
-            "refresh_token": refresh_token,
-            "scope": SCOPES,
-        }
+        access_token = await _refresh_access_token(db, token_entry)
+        future.set_result(access_token)
+        return access_token
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # mark retrieved when no caller was waiting
+        raise
+    finally:
+        # A cancelled leader skips the except above; release its followers
+        if not future.done():
+            future.cancel()
+        _refresh_inflight.pop(token_entry.user_id, None)
 
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(AZURE_TOKEN_URL, data=payload)
+async def _refresh_access_token(db: AsyncSession, token_entry: TokenStore) -> str:
+    seen_created_at = token_entry.created_at
+    async with _refresh_locks[token_entry.user_id]:
+        try:
+            # Another request may have refreshed while we waited on the lock;
+            # callers drop a rejected token from the cache before refreshing
+            cached = get_cached_access_token(token_entry.user_id)
+            if cached is not None:
+                return cached
+            await db.refresh(token_entry)
+            if seen_created_at and token_entry.created_at > seen_created_at:
+                access_token = await get_access_token(token_entry)
+                if access_token is not None:
+                    return access_token
+
+            refresh_token = get_cached_refresh_token(token_entry.user_id, token_entry.refresh_token)
+            if refresh_token is None:
+                refresh_token = await decrypt_stored(token_entry.refresh_token)
+            
+            payload = {**_REFRESH_BASE, "refresh_token": refresh_token}
+
+            resp = await graph_send("POST", AZURE_TOKEN_URL, data=payload)
             
             if resp.status_code != 200:
                 error_data = resp.json()
                 error_msg = error_data.get("error_description", "Unknown error during token refresh")
-                
+            
                 # Handle specific consent error
                 if "AADSTS65001" in error_msg:
                     raise HTTPException(
                         status_code=403,
                         detail="Admin consent required. Please have your administrator grant permissions to this application."
                     )
-                
+            
                 raise HTTPException(401, f"Token refresh failed: {error_msg}")
 
-            tokens = resp.json()
+            tokens = orjson.loads(resp.content)
             
             # Update the tokens in database
-            token_entry.access_token = encrypt(tokens["access_token"])
+            token_entry.access_token = None
             if "refresh_token" in tokens:
-                token_entry.refresh_token = encrypt(tokens["refresh_token"])
+                refresh_token = tokens["refresh_token"]
+                token_entry.refresh_token = encrypt(refresh_token)
+            token_entry.expires_in = tokens.get("expires_in", token_entry.expires_in)
+            token_entry.created_at = datetime.utcnow()
             
             db.add(token_entry)
-            db.commit()
+            await db.commit()
+            
+            if token_entry.expires_in:
+                cache_access_token(token_entry.user_id, tokens["access_token"], token_entry.expires_in)
+            cache_refresh_token(token_entry.user_id, token_entry.refresh_token, refresh_token)
             
             return tokens["access_token"]
             
-    except Exception as e:
-        logger.error(f"Token refresh error: {str(e)}")
-        raise HTTPException(500, "Internal server error during token refresh")
+        except HTTPException:
+            raise
+        except Exception:
+            logger.exception("Token refresh error")
+            raise HTTPException(500, "Internal server error during token refresh")
 
-async def fetch_user_info(access_token: str):
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-    }
-    
-    async with httpx.AsyncClient() as client:
-        return await client.get(f"{GRAPH_API}/me", headers=headers)
+async def fetch_user_info(headers: dict):
+    return await graph_send("GET", f"{GRAPH_API}/me", headers=headers)
 
 # ─── Router ────────────────────────────────────────────────────────────────────
-router = APIRouter(tags=["mail"])
+router = APIRouter(tags=["mail"], default_response_class=ORJSONResponse)
 
 @router.get("/fetch-emails")
-async def fetch_emails():
+async def fetch_emails(
+    pages: int = Query(1, ge=1, le=MAX_MESSAGE_PAGES),
+    db: AsyncSession = Depends(get_db),
+):
     """Fetch emails with proper permission handling"""
-    db = get_db_session()
-    try:
-        token_entry = db.query(TokenStore).first()
-        if not token_entry:
-            raise HTTPException(400, "No tokens found; please authenticate first")
+    # Cached tokens are only served while fresh, so a hit needs no DB row
+    token_entry = None
+    access_token = get_active_cached_token()
+    if access_token is None:
+        token_entry = await load_token_entry(db)
+        if token_entry.has_mailbox is False:
+            raise HTTPException(400, "User has no mailbox or mail access not enabled")
 
-        try:
-            # First get user info to check account type
-            access_token = decrypt(token_entry.access_token)
-            user_resp = await fetch_user_info(access_token)
-            
-            if user_resp.status_code != 200:
-                raise HTTPException(401, "Could not fetch user info")
-                
-            user_data = user_resp.json()
-            user_principal = user_data.get("userPrincipalName", "")
-            
-            # Check if it's a personal Microsoft account
-            if "#EXT#" in user_principal:
-                raise HTTPException(
-                    status_code=400,
-                    detail="Personal Microsoft accounts may require different permissions. "
-                           "Please use a work/school account or check the app registration permissions."
-                )
-            
-            # Try to fetch messages
-            resp = await fetch_messages(access_token)
-            
-            if resp.status_code == 401:
-                # Token expired, try to refresh
+    try:
+        if access_token is None:
+            if token_is_fresh(token_entry):
+                access_token = await get_access_token(token_entry)
+            if access_token is None:
+                # Not in memory, or close to expiry: refresh now rather than
+                # waiting for a 401 round-trip
                 access_token = await refresh_access_token(db, token_entry)
-                db.commit()
-                db.refresh(token_entry)
-                resp = await fetch_messages(access_token)
-                
-            if resp.status_code != 200:
-                error_data = resp.json()
-                error_msg = error_data.get("error", {}).get("message", "Unknown error")
-                raise HTTPException(resp.status_code, detail=error_msg)
-                
-            items = resp.json().get("value", [])
-            return {
-                "success": True,
-                "count": len(items),
-                "emails": [
-                    {
-                        "id": m.get("id"),
-                        "subject": m.get("subject"),
-                        "from": m.get("from", {}).get("emailAddress", {}).get("address"),
-                        "receivedDate": m.get("receivedDateTime"),
-                        "preview": m.get("bodyPreview"),
-                        "isRead": m.get("isRead", False),
-                        "hasAttachments": m.get("hasAttachments", False)
-                    }
-                    for m in items
-                ]
-            }
+
+        # User info and messages in a single $batch round trip; the messages
+        # are discarded if the account checks below fail
+        headers = graph_headers(access_token)
+        batch = await fetch_user_and_messages(headers)
+        
+        if 401 in (batch["me"]["status"], batch["messages"]["status"]):
+            # Token expired, try to refresh
+            if token_entry is None:
+                token_entry = await load_token_entry(db)
+            invalidate_access_token(token_entry.user_id)
+            _userinfo_cache.pop(token_entry.user_id, None)
+            access_token = await refresh_access_token(db, token_entry)
+            headers = graph_headers(access_token)
+            batch = await fetch_user_and_messages(headers)
+        
+        if batch["me"]["status"] == 429:
+            raise HTTPException(429, "Microsoft Graph is throttling requests; please retry later")
+        if batch["me"]["status"] != 200:
+            raise HTTPException(401, "Could not fetch user info")
             
-        except HTTPException as he:
-            raise he
-        except Exception as e:
-            logger.error(f"Error fetching emails: {str(e)}")
-            raise HTTPException(500, "Internal server error")
+        # The batch already paid for /me; let /user-info reuse it
+        cache_user_info(_active_user_id, batch["me"]["body"])
+        user_principal = batch["me"]["body"].get("userPrincipalName", "")
+        
+        # Check if it's a personal Microsoft account
+        if "#EXT#" in user_principal:
+            raise HTTPException(
+                status_code=400,
+                detail="Personal Microsoft accounts may require different permissions. "
+                       "Please use a work/school account or check the app registration permissions."
+            )
+        
+        messages = batch["messages"]
+        if is_mailbox_missing(messages):
+            if token_entry is None:
+                token_entry = await load_token_entry(db)
+            await record_mailbox(db, token_entry, False)
+            # Drop the cached token so the next call reads the flag and short-circuits
+            invalidate_access_token(token_entry.user_id)
+            raise HTTPException(400, "User has no mailbox or mail access not enabled")
+        
+        if messages["status"] != 200:
+            error_msg = messages.get("body", {}).get("error", {}).get("message", "Unknown error")
+            raise HTTPException(messages["status"], detail=error_msg)
             
-    finally:
-        db.close()
+        await record_mailbox(db, token_entry, True)
+        items = await fetch_more_messages(headers, messages["body"], pages)
+        # Returned as a response object so FastAPI skips the jsonable_encoder pass
+        return ORJSONResponse({
+            "success": True,
+            "count": len(items),
+            "emails": [email_summary(m) for m in items]
+        })
+        
+    except HTTPException as he:
+        raise he
+    except Exception:
+        logger.exception("Error fetching emails")
+        raise HTTPException(500, "Internal server error")
 
 # @router.post("/refresh-token")
 # async def refresh_token():
@@ -226,65 +478,71 @@ async def fetch_emails():
 #         db.close()
 
 @router.post("/logout")
-async def logout():
+async def logout(db: AsyncSession = Depends(get_db)):
     """Logout endpoint"""
-    db = get_db_session()
+    global _active_user_id, _token_row_id
     try:
-        token_entry = db.query(TokenStore).first()
-        if not token_entry:
+        # One DELETE ... RETURNING round trip instead of load + delete
+        first_row_id = select(TokenStore.id).limit(1).scalar_subquery()
+        stmt = delete(TokenStore).returning(TokenStore.user_id)
+        user_id = None
+        if _token_row_id is not None:
+            user_id = (await db.execute(stmt.where(TokenStore.id == _token_row_id))).scalar_one_or_none()
+        if user_id is None:
+            user_id = (await db.execute(stmt.where(TokenStore.id == first_row_id))).scalar_one_or_none()
+        await db.commit()
+        _active_user_id = None
+        _token_row_id = None
+        if user_id is None:
             return {"success": True, "message": "No active session found"}
         
-        db.delete(token_entry)
-        db.commit()
+        invalidate_access_token(user_id)
+        invalidate_refresh_token(user_id)
+        _userinfo_cache.pop(user_id, None)
         
         return {
             "success": True,
             "message": "Logged out successfully"
         }
         
-    except Exception as e:
-        logger.error(f"Logout error: {str(e)}")
+    except Exception:
+        logger.exception("Logout error")
         raise HTTPException(500, "Internal server error")
-    finally:
-        db.close()
 
 @router.get("/user-info")
-async def get_user_info():
+async def get_user_info(db: AsyncSession = Depends(get_db)):
     """Get user info with better error handling"""
-    db = get_db_session()
-    try:
-        token_entry = db.query(TokenStore).first()
-        if not token_entry:
-            raise HTTPException(400, "No tokens found; please authenticate first")
+    user_info = get_cached_user_info(_active_user_id)
+    if user_info is not None:
+        return user_info
 
-        try:
-            access_token = decrypt(token_entry.access_token)
-            resp = await fetch_user_info(access_token)
-            
-            if resp.status_code != 200:
-                raise HTTPException(401, "Could not fetch user info")
-                
-            user_data = resp.json()
-            
-            return {
-                "displayName": user_data.get("displayName"),
-                "userPrincipalName": user_data.get("userPrincipalName"),
-                "mail": user_data.get("mail"),
-                "userType": user_data.get("userType"),
-                "accountEnabled": user_data.get("accountEnabled"),
-                "id": user_data.get("id"),
-                "hasMailbox": user_data.get("mail") is not None,
-                "isPersonalAccount": "#EXT#" in user_data.get("userPrincipalName", "")
-            }
-            
-        except HTTPException as he:
-            raise he
-        except Exception as e:
-            logger.error(f"User info error: {str(e)}")
-            raise HTTPException(500, "Internal server error")
+    access_token = get_active_cached_token()
+    if access_token is None:
+        token_entry = await load_token_entry(db)
+
+    try:
+        if access_token is None:
+            if token_is_fresh(token_entry):
+                access_token = await get_access_token(token_entry)
+            if access_token is None:
+                access_token = await refresh_access_token(db, token_entry)
+        resp = await fetch_user_info(graph_headers(access_token))
+        
+        if resp.status_code == 429:
+            raise HTTPException(429, "Microsoft Graph is throttling requests; please retry later")
+        if resp.status_code != 200:
+            if resp.status_code == 401:
+                invalidate_access_token(_active_user_id)
+                _userinfo_cache.pop(_active_user_id, None)
+            raise HTTPException(401, "Could not fetch user info")
             
-    finally:
-        db.close()
+        return cache_user_info(_active_user_id, orjson.loads(resp.content))
+        
+    except HTTPException as he:
+        raise he
+    except Exception:
+        logger.exception("User info error")
+        raise HTTPException(500, "Internal server error")
 
 @router.get("/emails")
 async def get_stored_emails():
@@ -0,0 +1,27 @@
+from functools import lru_cache
+
+from pydantic import SecretStr
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+# Read .env and the environment once at import and validate up front, so a
+# missing credential fails at startup rather than on the first token refresh
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore", frozen=True)
+
+    client_id: str
+    client_secret: SecretStr
+    tenant_id: str
+    redirect_uri: str | None = None
+    scopes: str = "openid profile email User.Read Mail.Read offline_access"
+
+    @property
+    def authority(self) -> str:
+        return f"https://login.microsoftonline.com/{self.tenant_id}"
+
+    @property
+    def azure_token_url(self) -> str:
+        return f"{self.authority}/oauth2/v2.0/token"
+
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()
@@ -21,16 +21,91 @@
 #     return f.decrypt(token.encode()).decode()
 
 
-from cryptography.fernet import Fernet
+import base64
 import os
+from functools import lru_cache
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from dotenv import load_dotenv
 
 load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY")
-fernet = Fernet(SECRET_KEY.encode())
+# Rotation: comma-separated, newest first. New tokens use the first key;
+# older keys stay readable until every row has been re-saved
+SECRET_KEYS = [k.strip() for k in os.getenv("SECRET_KEYS", SECRET_KEY).split(",") if k.strip()]
 
-def encrypt(data: str) -> str:
-    return fernet.encrypt(data.encode()).decode()
+# Cipher setup is memoized per key so extra keys (e.g. for rotation) are
+# only parsed and derived once per process
+@lru_cache(maxsize=None)
+def fernet_for(secret_key: str) -> Fernet:
+    return Fernet(secret_key.encode())
 
-def decrypt(data: str) -> str:
-    return fernet.decrypt(data.encode()).decode()
+@lru_cache(maxsize=None)
+def aesgcm_for(secret_key: str) -> AESGCM:
+    # AES-256-GCM (single pass, AES-NI + CLMUL in OpenSSL) with a key derived
+    # from SECRET_KEY so no extra configuration is needed
+    return AESGCM(HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"outlook-token-aesgcm",
+    ).derive(base64.urlsafe_b64decode(secret_key)))
+
+# Tokens stored before the AES-GCM switch are Fernet; kept for decrypt only
+fernet = MultiFernet([fernet_for(k) for k in SECRET_KEYS])
+aesgcm = aesgcm_for(SECRET_KEYS[0])
+_previous = [aesgcm_for(k) for k in SECRET_KEYS[1:]]
+
+# Stored format: raw bytes version || nonce || ciphertext+tag in a
+# LargeBinary column, so neither direction pays a base64 pass
+TOKEN_VERSION = b"\x01"
+NONCE_SIZE = 12
+
+# Bound once so each call skips the module/attribute lookups
+_urandom = os.urandom
+_seal = aesgcm.encrypt
+_open = aesgcm.decrypt
+_VERSION_BYTE = TOKEN_VERSION[0]
+_BODY_START = 1 + NONCE_SIZE
+# Fernet tokens are base64 text whose 0x80 version byte encodes as "g"
+_FERNET_PREFIX = b"g"
+
+def encrypt(data: str) -> bytes:
+    nonce = _urandom(NONCE_SIZE)
+    return TOKEN_VERSION + nonce + _seal(nonce, data.encode(), None)
+
+def decrypt(data: bytes | str) -> str:
+    if isinstance(data, str):
+        # TEXT rows written before the LargeBinary switch come back as str
+        data = data.encode()
+    if data[0] != _VERSION_BYTE:
+        if data[:1] == _FERNET_PREFIX:
+            # Legacy Fernet token: its base64 text
+            return fernet.decrypt(bytes(data)).decode()
+        # base64 text of the AES-GCM layout, stored before raw bytes were
+        data = base64.urlsafe_b64decode(data)
+    # memoryview slices avoid copying the ciphertext before it reaches OpenSSL
+    view = memoryview(data)
+    nonce, sealed = view[1:_BODY_START], view[_BODY_START:]
+    try:
+        return _open(nonce, sealed, None).decode()
+    except InvalidTag:
+        # Sealed under an older key; a wrong key fails on the tag check
+        for cipher in _previous:
+            try:
+                return cipher.decrypt(nonce, sealed, None).decode()
+            except InvalidTag:
+                pass
+        raise
+
+def encrypt_batch(items: list[str]) -> list[bytes]:
+    """Encrypt several values with one urandom call for all their nonces"""
+    nonces = _urandom(NONCE_SIZE * len(items))
+    out = []
+    for i, data in enumerate(items):
+        nonce = nonces[i * NONCE_SIZE:(i + 1) * NONCE_SIZE]
+        out.append(TOKEN_VERSION + nonce + _seal(nonce, data.encode(), None))
+    return out
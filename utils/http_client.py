@@ -0,0 +1,21 @@
+import httpx
+
+# Shared client so Graph / token calls reuse pooled keep-alive (HTTP/2) connections
+# instead of paying a fresh TCP+TLS handshake on every request.
+_client = None
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30),
+            timeout=httpx.Timeout(10.0),
+        )
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,8 @@
+import orjson
+from fastapi.responses import JSONResponse
+
+class ORJSONResponse(JSONResponse):
+    """JSON response rendered with orjson instead of the stdlib encoder"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
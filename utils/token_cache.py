@@ -0,0 +1,69 @@
+import hashlib
+import hmac
+import os
+import time
+from datetime import datetime
+
+# Decrypted access tokens keyed by user_id -> (token, monotonic deadline)
+_TOKEN_CACHE: dict[str, tuple[str, float]] = {}
+
+# Decrypted refresh tokens keyed by user_id -> (fingerprint of the stored
+# ciphertext, token); a matching fingerprint proves the row is unchanged
+_REFRESH_CACHE: dict[str, tuple[bytes, str]] = {}
+_FINGERPRINT_KEY = os.urandom(32)
+
+# Stop serving a token 5 minutes before it expires (55 of 60 minutes). Tokens
+# shorter than 25 minutes would lose too much of their lifetime to that fixed
+# buffer, so they fall back to TOKEN_REFRESH_RATIO of it (800s of a 1000s token)
+TOKEN_REFRESH_BUFFER = 300
+TOKEN_REFRESH_RATIO = 0.8
+TOKEN_CACHE_MAXSIZE = 128
+
+def usable_lifetime(expires_in: int) -> float:
+    """Seconds a token is served; the margin is min(buffer, 20% of lifetime)"""
+    return max(expires_in - TOKEN_REFRESH_BUFFER, expires_in * TOKEN_REFRESH_RATIO)
+
+def get_cached_access_token(user_id: str) -> str | None:
+    cached = _TOKEN_CACHE.get(user_id)
+    if cached and time.monotonic() < cached[1]:
+        return cached[0]
+    return None
+
+def cache_access_token(user_id: str, access_token: str, expires_in: int, issued_at: datetime | None = None):
+    lifetime = usable_lifetime(expires_in)
+    if issued_at is not None:
+        lifetime -= (datetime.utcnow() - issued_at).total_seconds()
+    if lifetime > 0:
+        if user_id not in _TOKEN_CACHE and len(_TOKEN_CACHE) >= TOKEN_CACHE_MAXSIZE:
+            _TOKEN_CACHE.pop(next(iter(_TOKEN_CACHE)))  # evict the oldest entry
+        _TOKEN_CACHE[user_id] = (access_token, time.monotonic() + lifetime)
+
+def invalidate_access_token(user_id: str):
+    _TOKEN_CACHE.pop(user_id, None)
+
+def token_is_fresh(token_entry) -> bool:
+    """True until the stored token is within its refresh margin of expiry"""
+    if not token_entry.expires_in or not token_entry.created_at:
+        return True  # unknown lifetime; rely on the 401 fallback
+    age = (datetime.utcnow() - token_entry.created_at).total_seconds()
+    return age < usable_lifetime(token_entry.expires_in)
+
+def fingerprint(ciphertext: bytes | str) -> bytes:
+    if isinstance(ciphertext, str):
+        ciphertext = ciphertext.encode()  # TEXT row from before LargeBinary
+    return hashlib.blake2b(ciphertext, digest_size=16, key=_FINGERPRINT_KEY).digest()
+
+def get_cached_refresh_token(user_id: str, ciphertext: bytes) -> str | None:
+    """Plaintext for the stored ciphertext, hashed instead of decrypted"""
+    cached = _REFRESH_CACHE.get(user_id)
+    if cached and hmac.compare_digest(cached[0], fingerprint(ciphertext)):
+        return cached[1]
+    return None
+
+def cache_refresh_token(user_id: str, ciphertext: bytes, refresh_token: str):
+    if user_id not in _REFRESH_CACHE and len(_REFRESH_CACHE) >= TOKEN_CACHE_MAXSIZE:
+        _REFRESH_CACHE.pop(next(iter(_REFRESH_CACHE)))
+    _REFRESH_CACHE[user_id] = (fingerprint(ciphertext), refresh_token)
+
+def invalidate_refresh_token(user_id: str):
+    _REFRESH_CACHE.pop(user_id, None)
@@ -16,25 +16,92 @@
 #         return response.json()
 
 
-from models.db import SessionLocal, TokenStore
-from utils.encryption import encrypt
-from datetime import datetime
-
-def save_tokens(user_id: str, access_token: str, refresh_token: str, expires_in: int):
-    db = SessionLocal()
-    token = db.query(TokenStore).filter_by(user_id=user_id).first()
-    if token:
-        token.access_token = encrypt(access_token)
-        token.refresh_token = encrypt(refresh_token)
-        token.expires_in = expires_in
-        token.created_at = datetime.utcnow()
+import csv
+import io
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from models.db import TokenStore, upsert_insert, utcnow
+from utils.encryption import encrypt, encrypt_batch
+from utils.token_cache import cache_access_token, cache_refresh_token
+
+async def save_tokens(db: AsyncSession, user_id: str, access_token: str, refresh_token: str, expires_in: int):
+    values = {
+        "access_token": None,
+        "refresh_token": encrypt(refresh_token),
+        "expires_in": expires_in,
+        "created_at": utcnow(),
+        "has_mailbox": None,  # re-check the mailbox after a fresh sign-in
+    }
+    # Single INSERT ... ON CONFLICT instead of SELECT then UPDATE/INSERT
+    stmt = upsert_insert(TokenStore).values(user_id=user_id, **values)
+    stmt = stmt.on_conflict_do_update(index_elements=["user_id"], set_=values)
+
+    await db.execute(stmt)
+    await db.commit()
+    cache_access_token(user_id, access_token, expires_in)
+    cache_refresh_token(user_id, values["refresh_token"], refresh_token)
+
+# created_at is left to the column's server default
+_COPY_COLUMNS = ("user_id", "refresh_token", "expires_in")
+
+def save_tokens_bulk(db: Session, entries: list[tuple[str, str, str, int]], update_existing: bool = True):
+    """Save tokens for many users with one batched statement and one commit
+
+    With update_existing=False every user must be new, which lets Postgres
+    take the faster COPY path.
+    """
+    # Every refresh token in one encrypt_batch call
+    sealed = encrypt_batch([refresh_token for _, _, refresh_token, _ in entries])
+    rows = [
+        {
+            "user_id": user_id,
+            "access_token": None,
+            "refresh_token": enc_refresh,
+            "expires_in": expires_in,
+        }
+        for (user_id, _, _, expires_in), enc_refresh in zip(entries, sealed)
+    ]
+    if not rows:
+        return
+
+    if update_existing:
+        # executemany upsert; insertmanyvalues folds the rows into batched
+        # multi-row INSERT ... ON CONFLICT statements
+        stmt = upsert_insert(TokenStore).values(created_at=utcnow())
+        stmt = stmt.on_conflict_do_update(index_elements=["user_id"], set_={
+            "access_token": None,
+            "refresh_token": stmt.excluded.refresh_token,
+            "expires_in": stmt.excluded.expires_in,
+            "created_at": stmt.excluded.created_at,
+            "has_mailbox": None,
+        })
+        db.execute(stmt, rows)
+    elif db.get_bind().dialect.driver == "psycopg2":
+        _copy_tokens(db, rows)
     else:
-        token = TokenStore(
-            user_id=user_id,
-            access_token=encrypt(access_token),
-            refresh_token=encrypt(refresh_token),
-            expires_in=expires_in
-        )
-        db.add(token)
+        # executemany routes through SQLAlchemy's insertmanyvalues batching
+        db.execute(insert(TokenStore).values(created_at=utcnow()), rows)
     db.commit()
-    db.close()
+
+    for (user_id, access_token, refresh_token, expires_in), enc_refresh in zip(entries, sealed):
+        cache_access_token(user_id, access_token, expires_in)
+        cache_refresh_token(user_id, enc_refresh, refresh_token)
+
+def _copy_value(value):
+    # bytea columns take hex escape input in COPY's csv format
+    return "\\x" + value.hex() if isinstance(value, bytes) else value
+
+def _copy_tokens(db: Session, rows: list[dict]):
+    # Postgres COPY streams every row in a single round-trip
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(_copy_value(row[column]) for column in _COPY_COLUMNS)
+    buf.seek(0)
+
+    cursor = db.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY {TokenStore.__tablename__} ({', '.join(_COPY_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+        buf,
+    )